@@ -11,146 +11,49 @@ or relative times like '-1days'.
 """
 
 import argparse
+import re
 import time
 import logging
-from collections import defaultdict
-import requests
-from beautifultable import BeautifulTable
+from itertools import chain
+from urllib.parse import urlencode
 from decouple import config as decouple_config
-from requests.auth import HTTPBasicAuth
-from requests.exceptions import (
-    HTTPError,
-    ConnectionError as RequestsConnectionError,
-    Timeout,
-    RequestException,
-)
 
 # Set up logging based on environment variable
 log_level = decouple_config("LOG_LEVEL", default="INFO").upper()
 logging.basicConfig(level=getattr(logging, log_level))
-logger = logging.getLogger(__name__)
 
+RELATIVE_DATE_PATTERN = re.compile(r"days|weeks|minutes|seconds|now")
 
-class Config:  # pylint: disable=R0903
-    """Handles configuration using decouple for environment variables."""
+VALID_VERDICTS = frozenset(("allowed", "blocked", "proxied"))
 
-    def __init__(self):
-        self.token_url = decouple_config(
-            "TOKEN_URL", default="https://api.umbrella.com/auth/v2/token"
-        )
-        self.report_url = decouple_config(
-            "REPORT_URL", default="https://api.umbrella.com/reports/v2"
-        )
-        self.categories_url = decouple_config(
-            "CATEGORIES_URL", default="https://api.umbrella.com/reports/v2/categories"
-        )
-        self.client_id = decouple_config("API_KEY")
-        self.client_secret = decouple_config("API_SECRET")
-
-
-class OAuth2Authenticator:  # pylint: disable=R0903
-    """Handles OAuth2 authentication to retrieve an access token."""
-
-    def __init__(self, config):
-        """Initializes the authenticator with the given configuration."""
-        self.token_url = config.token_url
-        self.client_id = config.client_id
-        self.client_secret = config.client_secret
-        self.token = None
-
-    def authenticate(self):
-        """Authenticates with the OAuth2 endpoint and sets the access token.
-
-        Returns:
-            dict: The retrieved OAuth2 access token.
-        """
-        auth = HTTPBasicAuth(self.client_id, self.client_secret)
-        try:
-            response = requests.post(self.token_url, auth=auth, timeout=10)
-            response.raise_for_status()
-            self.token = response.json()
-            logger.info("Authentication successful.")
-            return self.token
-        except (HTTPError, RequestsConnectionError, Timeout, RequestException) as err:
-            logger.error("Error during authentication: %s", err)
-            raise
-
-class UmbrellaAPIClient:  # pylint: disable=R0903
-    """API client for the Umbrella service that handles making requests."""
-
-    def __init__(self, authenticator, base_url):
-        """Initializes the API client with an authenticator and base URL."""
-        self.authenticator = authenticator
-        self.base_url = base_url
-
-    def query(self, endpoint):
-        """Queries the API at the specified endpoint and returns the response data."""
-        if not self.authenticator.token:
-            self.authenticator.authenticate()
-        headers = {
-            "Authorization": f"Bearer {self.authenticator.token['access_token']}"
-        }
-        logger.info(
-            "Requesting data from API endpoint: %s", f"{self.base_url}/{endpoint}"
-        )
-        try:
-            response = requests.get(
-                f"{self.base_url}/{endpoint}", headers=headers, timeout=10
-            )
-            response.raise_for_status()
-            logger.info("API query successful.")
-            return response.json()
-        except HTTPError as http_err:
-            if response.status_code == 429:
-                logger.warning(
-                    "Rate limit exceeded. Status code: 429. Retrying after backoff."
-                )
-                time.sleep(60)  # Exponential backoff could be used here
-                return self.query(endpoint)  # Recursive retry
-            if response.status_code in [503, 504]:
-                logger.warning(
-                    "Service unavailable. Status code: %s. Retrying...",
-                    response.status_code,
-                )
-                time.sleep(30)  # Backoff for service unavailability
-                return self.query(endpoint)  # Recursive retry
-
-            logger.error("HTTP error occurred: %s", http_err)
-            raise
-        except (RequestsConnectionError, Timeout) as conn_err:
-            logger.error("Network error occurred: %s", conn_err)
-            raise
-        except RequestException as req_err:
-            logger.error("Request error occurred: %s", req_err)
-            raise
-
-
-def get_security_category_ids(api_client):
-    """Retrieves all category IDs that are security-relevant."""
-    categories_data = api_client.query("categories")
-    category_map = {}
-    for category in categories_data.get("data", []):
-        if category["type"] == "security":
-            category_map[category["label"]] = category["id"]
-    return category_map
+# Fallbacks for activity records without identities or policy categories
+UNKNOWN_IDENTITIES = ({"label": "Unknown"},)
+UNKNOWN_CATEGORIES = ({"label": "N/A"},)
 
 
 def is_relative_date(value):
     """Checks if the given value is a relative date."""
-    valid_words = ["days", "weeks", "minutes", "now", "seconds"]
-    return any(word in value for word in valid_words)
+    return RELATIVE_DATE_PATTERN.search(value) is not None
 
 
 def check_date(value):
-    """Validates the date value to ensure it's either a relative time string or a past timestamp."""
+    """Validates the date value to ensure it's either a relative time string or a past timestamp.
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is neither, so argparse rejects it
+            before any request is made.
+    """
     if is_relative_date(value):
         return value
     try:
         if int(time.time()) - int(value) >= 0:
             return value
     except ValueError:
-        logger.error("Invalid date value: %s", value)
-    return None
+        pass
+    raise argparse.ArgumentTypeError(
+        f"invalid date value: '{value}' (use a past timestamp or a relative time "
+        "like '-1days')"
+    )
 
 
 def validate_dates(from_date, to_date):
@@ -167,66 +70,121 @@ class DataPresenter:  # pylint: disable=R0903
     """Handles the presentation of data in various formats."""
 
     def __init__(self, data):
-        """Initializes the DataPresenter with the data to present."""
+        """Initializes the DataPresenter with the data to present.
+
+        The data can be any iterable of records, e.g. a generator over report
+        pages. It is consumed once, record by record, while building the table.
+        """
         self.data = data
 
     def present_as_table(self, report_type):
-        """Presents the data as a table using BeautifulTable."""
+        """Presents the data as a table using BeautifulTable.
+
+        The column header is set before any row is added, so the table layout is
+        fixed up front and rows are only appended; column widths are computed
+        once when the table is rendered.
+        """
+        # Imported here so that --help and early errors do not pay for it
+        from beautifultable import BeautifulTable  # pylint: disable=C0415
+
+        header, rows = self._rows(report_type)
         status_table = BeautifulTable()
-        if report_type == "deployment":
-            for item in self.data:
-                status_table.rows.append(
-                    [item["type"]["label"], item["activecount"], item["count"]]
-                )
-            status_table.columns.header = ["Label", "Active", "Count"]
-        elif report_type == "activity":
-            identity_domain_map = defaultdict(lambda: defaultdict(int))
-            identity_category_map = defaultdict(lambda: defaultdict(set))
-            last_seen_map = defaultdict(lambda: defaultdict(str))
-
-            for item in self.data:
-                identity = item.get("identities", [{"label": "Unknown"}])[0]["label"]
-                domain = item.get("domain", "N/A")
-                category = item.get("policycategories", [{"label": "N/A"}])[0]["label"]
-                last_seen = item.get("date", "N/A")
-
-                identity_domain_map[identity][domain] += 1
-                identity_category_map[identity][domain].add(category)
-                if last_seen_map[identity][domain] < last_seen:
-                    last_seen_map[identity][domain] = last_seen
-
-            for identity, domains in identity_domain_map.items():
-                for domain, count in domains.items():
-                    categories = ", ".join(identity_category_map[identity][domain])
-                    last_seen = last_seen_map[identity][domain]
-                    status_table.rows.append(
-                        [identity, domain, count, categories, last_seen]
-                    )
-
-            status_table.columns.header = [
-                "Identity",
-                "Domain",
-                "Count",
-                "Category",
-                "Last Seen",
-            ]
+        if header:
+            status_table.columns.header = header
+        for row in rows:
+            status_table.rows.append(row)
         return status_table
 
+    def present_as_markdown(self, report_type):
+        """Presents the data as a Markdown table built with plain string joins.
 
-def validate_verdict(verdict):
-    """Validates that the verdict contains only allowed values."""
-    valid_verdicts = {"allowed", "blocked", "proxied"}
+        This avoids BeautifulTable's per-cell width measuring, which makes it much
+        faster for large reports. Column widths are based on len(), so cells with
+        wide Unicode characters may be misaligned. Pipes in cells are escaped so
+        they do not split a cell into additional columns.
+        """
+        header, rows = self._rows(report_type)
+        rows = [[str(cell).replace("|", "\\|") for cell in row] for row in rows]
+        widths = [
+            max([len(title)] + [len(row[column]) for row in rows])
+            for column, title in enumerate(header)
+        ]
+
+        def format_row(cells):
+            return (
+                "| "
+                + " | ".join(cell.ljust(width) for cell, width in zip(cells, widths))
+                + " |"
+            )
 
-    if verdict:
-        # Split the input by commas and trim whitespace
-        verdicts = {v.strip().lower() for v in verdict.split(",")}
+        lines = [format_row(header)]
+        lines.append("|" + "|".join("-" * (width + 2) for width in widths) + "|")
+        lines.extend(format_row(row) for row in rows)
+        return "\n".join(lines)
 
-        # Check if all provided verdicts are in the set of valid verdicts
-        if not verdicts.issubset(valid_verdicts):
-            raise ValueError(
-                f"Invalid verdict value(s) provided: {verdict}. "
-                f"Allowed values are: {', '.join(valid_verdicts)}"
+    def _rows(self, report_type):
+        """Returns the column header and an iterator over the rows of the report."""
+        if report_type == "deployment":
+            return ["Label", "Active", "Count"], (
+                [item["type"]["label"], item["activecount"], item["count"]]
+                for item in self.data
             )
+        if report_type == "activity":
+            return ["Identity", "Domain", "Count", "Category", "Last Seen"], (
+                [identity, domain, count, ", ".join(categories), last_seen]
+                for identity, domains in self._aggregate_activity().items()
+                for domain, (count, categories, last_seen) in domains.items()
+            )
+        return [], []
+
+    def _aggregate_activity(self):
+        """Returns count, categories and last seen date per domain, grouped by identity."""
+        aggregated = {}
+        get_domains = aggregated.get  # Saves an attribute lookup per record
+        for item in self.data:
+            identity = (item.get("identities") or UNKNOWN_IDENTITIES)[0]["label"]
+            domain = item.get("domain", "N/A")
+            category = (item.get("policycategories") or UNKNOWN_CATEGORIES)[0]["label"]
+            last_seen = item.get("date", "N/A")
+
+            domains = get_domains(identity)
+            if domains is None:
+                domains = aggregated[identity] = {}
+            entry = domains.get(domain)
+            if entry is None:
+                entry = domains[domain] = [0, set(), ""]
+            entry[0] += 1
+            entry[1].add(category)
+            if entry[2] < last_seen:
+                entry[2] = last_seen
+        return aggregated
+
+
+def build_report_query(args, category_filter, limit):
+    """Builds the report endpoint and its query parameters except the page offset.
+
+    Returns:
+        tuple: The endpoint and the URL-encoded query string.
+    """
+    params = {"from": args.from_date, "to": args.to_date, "limit": limit}
+    if args.report_type == "activity":
+        if args.verdict:
+            params["verdict"] = args.verdict
+        params["categories"] = category_filter
+        return "activity", urlencode(params, safe=",")
+    return "deployment-status", urlencode(params, safe=",")
+
+
+def validate_verdict(verdict):
+    """Validates that the verdict contains only allowed values."""
+    # Check each comma-separated verdict, stopping at the first invalid one
+    if verdict and any(
+        v.strip().lower() not in VALID_VERDICTS for v in verdict.split(",")
+    ):
+        raise ValueError(
+            f"Invalid verdict value(s) provided: {verdict}. "
+            f"Allowed values are: {', '.join(sorted(VALID_VERDICTS))}"
+        )
     return verdict
 
 
@@ -259,6 +217,12 @@ def main():
         default="now",
         type=check_date,
     )
+    parser.add_argument(
+        "--format",
+        help="Output format: 'table' (default) or 'markdown'.",
+        default="table",
+        choices=["table", "markdown"],
+    )
     parser.add_argument(
         "--verdict",
         help="A verdict string to filter activity report (e.g., 'allowed,blocked,proxied').",
@@ -271,52 +235,44 @@ def main():
     # Validate that from_date and to_date are consistent
     validate_dates(args.from_date, args.to_date)
 
+    # Imported after argument parsing, so --help and invalid arguments do not
+    # pay for loading requests
+    import umbrella_client  # pylint: disable=C0415
+
     # Load configuration
-    config = Config()
+    config = umbrella_client.Config()
 
-    authenticator = OAuth2Authenticator(config)
-    api_client = UmbrellaAPIClient(authenticator, config.report_url)
+    # The API client reuses the authenticator's session, so the token request
+    # and all report queries share one connection pool
+    authenticator = umbrella_client.OAuth2Authenticator(
+        config, umbrella_client.create_session(config.prefetch_workers)
+    )
+    api_client = umbrella_client.UmbrellaAPIClient(authenticator, config.report_url)
 
     # Retrieve security-relevant category IDs for filtering
-    category_ids = get_security_category_ids(api_client)
-    category_filter = ",".join(str(id) for id in category_ids.values())
+    category_ids = umbrella_client.get_security_category_ids(
+        api_client,
+        umbrella_client.cache_file_path(
+            config.cache_dir, "categories", config.report_url, config.client_id
+        ),
+    )
+    category_filter = ",".join(map(str, category_ids.values()))
 
-    offset = 0
     limit = 100
-    all_data = []
-    endpoint = None
+    endpoint, query = build_report_query(args, category_filter, limit)
+    # Records are handed to the presenter page by page, so each page can be
+    # released once it has been added to the table
+    records = chain.from_iterable(
+        umbrella_client.fetch_pages(
+            api_client, endpoint, query, limit, config.prefetch_workers
+        )
+    )
 
-    while True:
-        if args.report_type == "deployment":
-            params = (
-                f"from={args.from_date}&to={args.to_date}&limit={limit}&offset={offset}"
-            )
-            endpoint = f"deployment-status?{params}"
-        elif args.report_type == "activity":
-            params = (
-                f"from={args.from_date}&to={args.to_date}&limit={limit}&offset={offset}"
-            )
-            if args.verdict:
-                params += f"&verdict={args.verdict}"
-            params += f"&categories={category_filter}"
-            endpoint = f"activity?{params}"
-
-        if endpoint is None:
-            logger.error("No endpoint defined. Exiting.")
-            return
-
-        logger.info("Final API request URL: %s", f"{api_client.base_url}/{endpoint}")
-        response = api_client.query(endpoint)
-        data = response.get("data", [])
-        all_data.extend(data)
-
-        # Check if the number of results matches the limit
-        if len(data) < limit:
-            break  # If less than the limit, assume no more data is available
-        offset += limit  # Increment offset to get the next set of results
-
-    presenter = DataPresenter(all_data)
-    status_table = presenter.present_as_table(args.report_type)
+    presenter = DataPresenter(records)
+    if args.format == "markdown":
+        status_table = presenter.present_as_markdown(args.report_type)
+    else:
+        status_table = presenter.present_as_table(args.report_type)
     print(
         f"{args.report_type.capitalize()} Report between "
         f"{args.from_date} and {args.to_date}"
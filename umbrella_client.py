@@ -0,0 +1,550 @@
+"""
+Client for the Umbrella reporting API used by umbrella.py.
+
+It handles OAuth2 client credentials authentication with an on-disk token cache,
+a pooled HTTP session, retries with backoff, a circuit breaker for sustained
+outages and concurrent pagination of report endpoints. Configuration is read
+from environment variables (or a .env file) using decouple.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import requests
+from decouple import config as decouple_config
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    HTTPError,
+    ConnectionError as RequestsConnectionError,
+    Timeout,
+    RequestException,
+)
+from urllib3.util import Retry
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a connection and for response data on every request
+HTTP_TIMEOUT = (5.0, 30.0)
+
+# Default number of report pages requested concurrently and connection pool size
+PREFETCH_WORKERS = 8
+
+# Form body of every client credentials token request
+TOKEN_REQUEST_BODY = b"grant_type=client_credentials"
+
+# Retries for rate limited (429) or temporarily unavailable (503, 504) requests
+RETRY_STATUS_CODES = (429, 503, 504)
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+
+# Seconds for which the security category catalog is reused from the cache
+CATEGORIES_CACHE_TTL = 24 * 60 * 60
+
+
+def create_session(pool_maxsize=PREFETCH_WORKERS):
+    """Creates a pooled HTTP session shared by the authenticator and the API client.
+
+    Reusing one session keeps the connection to the Umbrella API alive, so the
+    token request and all report pages share a single TLS handshake. The pool
+    should be at least as large as the number of concurrent page requests.
+    """
+    session = requests.Session()
+    # Report pages are JSON, which compresses well, so always ask for gzip
+    session.headers.update(
+        {
+            "User-Agent": f"umbrella-reporting {requests.utils.default_user_agent()}",
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+        }
+    )
+    # One pooled connection per prefetch worker, so concurrent page requests
+    # never have to open and discard extra connections. Only failed connection
+    # attempts are retried here, HTTP status codes are handled by the API client.
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=3,
+            read=False,
+            status=0,
+            backoff_factor=0.5,
+            respect_retry_after_header=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def retry_delay(response, attempt):
+    """Returns the seconds to wait before retrying a rejected request.
+
+    Uses the Retry-After header if present, otherwise a random delay between
+    zero and the exponentially growing backoff (full jitter). Both are capped
+    at BACKOFF_CAP.
+    """
+    try:
+        return min(BACKOFF_CAP, max(0.0, float(response.headers["Retry-After"])))
+    except (KeyError, ValueError):
+        backoff = min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt)
+        # Jitter only spreads out retries, it is not security relevant
+        return random.uniform(0, backoff)  # nosec B311
+
+
+def cache_file_path(cache_dir, name, *key_parts):
+    """Returns the path of a cache file whose name is derived from the key parts.
+
+    Hashing the key parts (e.g. URL and client ID) lets caches for different
+    configurations coexist in the same directory.
+    """
+    cache_key = hashlib.sha256("".join(key_parts).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{name}_{cache_key}.json")
+
+
+def read_cache_file(path):
+    """Returns the data from a JSON cache file, raising OSError or ValueError."""
+    with open(path, "rb") as cache_file:
+        return orjson.loads(cache_file.read())
+
+
+def write_cache_file(path, data):
+    """Atomically writes data as JSON to a cache file readable only by the current user."""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        file_descriptor = os.open(
+            temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        with os.fdopen(file_descriptor, "wb") as cache_file:
+            cache_file.write(orjson.dumps(data))
+        os.replace(temp_path, path)
+    except OSError as err:
+        logger.warning("Could not write cache file %s: %s", path, err)
+
+
+class Config:  # pylint: disable=R0903
+    """Handles configuration using decouple for environment variables."""
+
+    def __init__(self):
+        self.token_url = decouple_config(
+            "TOKEN_URL", default="https://api.umbrella.com/auth/v2/token"
+        )
+        self.report_url = decouple_config(
+            "REPORT_URL", default="https://api.umbrella.com/reports/v2"
+        )
+        self.categories_url = decouple_config(
+            "CATEGORIES_URL", default="https://api.umbrella.com/reports/v2/categories"
+        )
+        self.client_id = decouple_config("API_KEY")
+        self.client_secret = decouple_config("API_SECRET")
+        self.cache_dir = decouple_config(
+            "CACHE_DIR", default=os.path.expanduser("~/.cache/umbrella")
+        )
+        self.prefetch_workers = max(
+            1, decouple_config("PREFETCH_WORKERS", default=PREFETCH_WORKERS, cast=int)
+        )
+
+
+class OAuth2Authenticator:  # pylint: disable=R0902,R0903
+    """Handles OAuth2 authentication to retrieve an access token.
+
+    Tokens are cached on disk until shortly before they expire, so repeated
+    invocations of the script do not each request a new token. The expiry is
+    also tracked in memory, so long report runs refresh the token in time.
+    """
+
+    # Seconds subtracted from the token lifetime to avoid using it right at expiry
+    expiry_margin = 60
+    # Lifetime assumed if the token endpoint does not return expires_in
+    default_lifetime = 3600
+
+    def __init__(self, config, session=None):
+        """Initializes the authenticator with the given configuration and HTTP session."""
+        self.token_url = config.token_url
+        self.client_id = config.client_id
+        self.client_secret = config.client_secret
+        self.session = session or create_session()
+        self.token = None
+        self.auth_header = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+        self.cache_path = cache_file_path(
+            config.cache_dir, "token", self.token_url, self.client_id
+        )
+        # The Basic credentials never change, so they are encoded only once
+        credentials = f"{self.client_id}:{self.client_secret}".encode()
+        self.token_request_headers = {
+            "Authorization": f"Basic {base64.b64encode(credentials).decode()}",
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+
+    def authenticate(self, use_cache=True):
+        """Authenticates with the OAuth2 endpoint and sets the access token.
+
+        A still valid token in memory is kept as it is. Unless use_cache is
+        False, a still valid token from the on-disk cache is used next, without
+        contacting the token endpoint. Rate limited or temporarily unavailable
+        token requests are retried like API queries.
+
+        Returns:
+            dict: The retrieved OAuth2 access token.
+        """
+        # Concurrent page requests may re-authenticate at the same time
+        with self._lock:
+            return self._authenticate(use_cache)
+
+    def get_auth_header(self):
+        """Returns the request header of a valid token, authenticating if needed.
+
+        The check and the read happen under the lock, so a token discarded by
+        another thread in between never results in a request without a header.
+        """
+        with self._lock:
+            self._authenticate(use_cache=True)
+            return self.auth_header
+
+    def _authenticate(self, use_cache):
+        if self.is_valid():
+            # Another thread refreshed the token while this one was waiting
+            return self.token
+        cached_token = self._load_cached_token() if use_cache else None
+        if cached_token:
+            self._set_token(cached_token, cached_token["expires_at"])
+            logger.info("Using cached access token.")
+            return self.token
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(
+                    self.token_url,
+                    headers=self.token_request_headers,
+                    data=TOKEN_REQUEST_BODY,
+                    timeout=HTTP_TIMEOUT,
+                )
+                response.raise_for_status()
+                token = orjson.loads(response.content)
+                lifetime = int(token.get("expires_in", self.default_lifetime))
+                expires_at = time.time() + lifetime - self.expiry_margin
+                self._set_token(token, expires_at)
+                logger.info("Authentication successful.")
+                break
+            except HTTPError as err:
+                if response.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+                    delay = retry_delay(response, attempt)
+                    logger.warning(
+                        "Token request failed. Status code: %s. "
+                        "Retrying in %.1f seconds (attempt %s of %s).",
+                        response.status_code,
+                        delay,
+                        attempt + 1,
+                        MAX_RETRIES,
+                    )
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                logger.error("Error during authentication: %s", err)
+                raise
+            except (
+                RequestsConnectionError,
+                Timeout,
+                RequestException,
+                orjson.JSONDecodeError,
+            ) as err:
+                logger.error("Error during authentication: %s", err)
+                raise
+        write_cache_file(
+            self.cache_path,
+            {"access_token": token["access_token"], "expires_at": expires_at},
+        )
+        return token
+
+    def is_valid(self):
+        """Returns True if there is a token that has not (nearly) expired yet."""
+        return self.auth_header is not None and time.time() < self.expires_at
+
+    def invalidate(self, rejected_header):
+        """Discards the current token after the API rejected the given header.
+
+        If another thread has already replaced the rejected token, the new
+        token is kept, so concurrent rejections lead to a single refresh.
+        """
+        with self._lock:
+            if self.auth_header == rejected_header:
+                self.token = None
+                self.auth_header = None
+                self.expires_at = 0
+
+    def _set_token(self, token, expires_at):
+        """Sets the token and builds the request header once for all queries."""
+        self.token = token
+        self.expires_at = expires_at
+        self.auth_header = {"Authorization": f"Bearer {token['access_token']}"}
+
+    def _load_cached_token(self):
+        """Returns the cached token if it exists and has not expired, otherwise None."""
+        try:
+            token = read_cache_file(self.cache_path)
+            if "access_token" in token and time.time() < token["expires_at"]:
+                return token
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+
+class CircuitOpenError(RequestException):
+    """Raised when a request is rejected because the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stops calling the API after repeated failures until a recovery timeout passes.
+
+    The breaker starts CLOSED and lets all requests through. After
+    failure_threshold consecutive failures it becomes OPEN and rejects requests
+    without touching the network. Once recovery_timeout seconds have passed it
+    becomes HALF_OPEN and lets a single trial request through, which either
+    closes the breaker again or re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        """Initializes a closed circuit breaker."""
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def is_closed(self):
+        """Returns True if the breaker lets all requests through."""
+        with self._lock:
+            return self.state == self.CLOSED
+
+    def allow_request(self):
+        """Returns True if a request may be sent in the current state."""
+        with self._lock:
+            return self._allow_request()
+
+    def _allow_request(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.trial_in_flight = False
+            logger.info("Circuit breaker half-open, sending a trial request.")
+        if self.state == self.HALF_OPEN:
+            if self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+        return True
+
+    def record_success(self):
+        """Closes the breaker and resets the failure count."""
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit breaker closed.")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        """Counts a failure and opens the breaker once the threshold is reached."""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.error(
+                        "Circuit breaker opened after %s consecutive failures.",
+                        self.failures,
+                    )
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+
+
+class UmbrellaAPIClient:  # pylint: disable=R0903
+    """API client for the Umbrella service that handles making requests."""
+
+    def __init__(self, authenticator, base_url, session=None, circuit_breaker=None):
+        """Initializes the API client with an authenticator, base URL and HTTP session."""
+        self.authenticator = authenticator
+        self.base_url = base_url
+        self.session = session or authenticator.session
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+    def query(self, endpoint, params=None, stop_event=None):
+        """Queries the API at the specified endpoint and returns the response data.
+
+        Query parameters are passed separately, as a dict or an already encoded
+        query string, and added to the URL by requests.
+
+        Rate limiting (429) and temporary unavailability (503, 504) are retried
+        up to MAX_RETRIES times, waiting as long as retry_delay() returns. A
+        rejected token (401) triggers a single re-authentication. Server errors
+        and network failures are counted by the circuit breaker, which raises
+        CircuitOpenError instead of querying an API that keeps failing. Once
+        the breaker has opened, retries stop and the last HTTP error is raised.
+        The same happens if stop_event is set before or while waiting to retry.
+        """
+        url = f"{self.base_url}/{endpoint}"
+        logger.info(
+            "Requesting data from API endpoint: %s with parameters: %s", url, params
+        )
+        attempt = 0
+        reauthenticated = False
+        while True:
+            headers = self.authenticator.get_auth_header()
+            if not self.circuit_breaker.allow_request():
+                logger.error("Circuit breaker open. Not querying %s", url)
+                raise CircuitOpenError(f"Circuit breaker open, not querying {url}")
+            try:
+                response = self.session.get(
+                    url, headers=headers, params=params, timeout=HTTP_TIMEOUT
+                )
+                # Only server errors count towards the breaker, client errors
+                # show that the API itself is reachable and answering
+                if response.status_code >= 500:
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_success()
+                response.raise_for_status()
+                logger.info("API query successful.")
+                logger.debug(
+                    "Response content encoding: %s",
+                    response.headers.get("Content-Encoding", "identity"),
+                )
+                return orjson.loads(response.content)
+            except HTTPError as http_err:
+                if response.status_code == 401 and not reauthenticated:
+                    logger.warning("Access token rejected. Re-authenticating.")
+                    self.authenticator.invalidate(headers)
+                    self.authenticator.authenticate(use_cache=False)
+                    reauthenticated = True
+                    continue
+                # Waiting for a retry is pointless once the breaker has opened,
+                # so the actual HTTP error is raised right away instead
+                if (
+                    response.status_code in RETRY_STATUS_CODES
+                    and attempt < MAX_RETRIES
+                    and self.circuit_breaker.is_closed()
+                ):
+                    delay = retry_delay(response, attempt)
+                    logger.warning(
+                        "%s Status code: %s. Retrying in %.1f seconds (attempt %s of %s).",
+                        (
+                            "Rate limit exceeded."
+                            if response.status_code == 429
+                            else "Service unavailable."
+                        ),
+                        response.status_code,
+                        delay,
+                        attempt + 1,
+                        MAX_RETRIES,
+                    )
+                    # Without a stop event, this waits for the full delay
+                    if (stop_event or threading.Event()).wait(delay):
+                        logger.debug("Retry of %s abandoned.", url)
+                        raise
+                    attempt += 1
+                    continue
+
+                logger.error("HTTP error occurred: %s", http_err)
+                raise
+            except (RequestsConnectionError, Timeout) as conn_err:
+                self.circuit_breaker.record_failure()
+                logger.error("Network error occurred: %s", conn_err)
+                raise
+            except RequestException as req_err:
+                # E.g. a broken gzip or chunked body. Recording it also releases
+                # the trial request of a half-open breaker.
+                self.circuit_breaker.record_failure()
+                logger.error("Request error occurred: %s", req_err)
+                raise
+            except orjson.JSONDecodeError as json_err:
+                # E.g. an HTML error page of a proxy returned with status 200
+                logger.error("Request error occurred: %s", json_err)
+                raise
+
+
+def get_security_category_ids(api_client, cache_path=None):
+    """Retrieves all category IDs that are security-relevant.
+
+    If a cache path is given, the result is read from there while the file is
+    younger than CATEGORIES_CACHE_TTL, and written there after fetching it.
+    Only non-empty maps are cached, so an empty or invalid cache file never
+    disables the category filter.
+    """
+    if cache_path:
+        try:
+            if time.time() - os.path.getmtime(cache_path) < CATEGORIES_CACHE_TTL:
+                category_map = read_cache_file(cache_path)
+                if category_map and isinstance(category_map, dict):
+                    logger.info("Using cached security categories.")
+                    return category_map
+        except (OSError, ValueError):
+            pass
+    categories_data = api_client.query("categories")
+    category_map = {
+        category["label"]: category["id"]
+        for category in categories_data.get("data", [])
+        if category["type"] == "security"
+    }
+    if cache_path and category_map:
+        write_cache_file(cache_path, category_map)
+    return category_map
+
+
+def fetch_pages(api_client, endpoint, query, limit, max_workers=PREFETCH_WORKERS):
+    """Yields the data of consecutive report pages in offset order.
+
+    The endpoint is queried with the encoded query string plus an increasing
+    offset parameter. The first page is fetched on its own. If it is full, up
+    to max_workers following pages are requested concurrently over the shared
+    session, and a new page is requested whenever a full page has been
+    consumed. Paging stops at the first page with less than limit results.
+    """
+
+    # Set once the pages are no longer needed, so requests still in flight
+    # give up instead of waiting to retry
+    stop_event = threading.Event()
+
+    def query_page(offset):
+        return api_client.query(
+            endpoint, f"{query}&offset={offset}", stop_event=stop_event
+        ).get("data", [])
+
+    data = query_page(0)
+    yield data
+    if len(data) < limit:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    next_offset = limit
+    pending = deque()
+    try:
+        for _ in range(max_workers):
+            pending.append(executor.submit(query_page, next_offset))
+            next_offset += limit
+        while pending:
+            data = pending.popleft().result()
+            yield data
+            if len(data) < limit:
+                break  # If less than the limit, assume no more data is available
+            pending.append(executor.submit(query_page, next_offset))
+            next_offset += limit
+    finally:
+        # Pages past the end of the report, or after a failed page, are not
+        # needed anymore, so they are neither waited for nor retried
+        stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)